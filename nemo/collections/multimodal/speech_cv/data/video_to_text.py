@@ -13,9 +13,15 @@
 # limitations under the License.
 
 import os
-from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+import queue
+import random
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import braceexpand
+import numpy as np
 import torch
 import webdataset as wd
 
@@ -33,72 +39,76 @@ from nemo.utils.data_utils import datastore_path_to_webdataset_url, is_datastore
 def _video_speech_collate_fn(batch, pad_id):
     """collate batch of video sig, video len, tokens, tokens len
     Args:
-        batch (Optional[FloatTensor], Optional[LongTensor], LongTensor,
-               LongTensor):  A tuple of tuples of signal, signal lengths,
-               encoded tokens, and encoded tokens length.  This collate func
+        batch (List[Dict[str, Tensor]]):  A list of samples, each a dict of signal ('video'),
+               signal length ('video_len'), encoded tokens ('tokens'), encoded tokens
+               length ('tokens_len') and optionally the sample id ('sample_id').  Lengths are Python ints,
+               length tensors are built once per batch.  This collate func
                assumes the signals are 4d torch tensors (Time, Height, Width, Channels).
+               Video frames are kept as uint8, conversion to float and normalization
+               are done on device by the model preprocessor.
+    Returns:
+        A tuple of padded signals, signal lengths, padded tokens, tokens lengths and optionally sample ids.
     """
-    packed_batch = list(zip(*batch))
-
-    if len(packed_batch) == 5:
-        _, video_lengths, _, tokens_lengths, sample_ids = packed_batch
-    elif len(packed_batch) == 4:
-        sample_ids = None
-        _, video_lengths, _, tokens_lengths = packed_batch
-    else:
-        raise ValueError("Expects 4 or 5 tensors in the batch!")
+    batch_size = len(batch)
 
     # Max Video Len
-    max_video_len = 0
-    has_video = video_lengths[0] is not None
-    if has_video:
-        max_video_len = max(video_lengths).item()
+    video_lens = np.fromiter((b['video_len'] for b in batch), dtype=np.int64, count=batch_size)
+    max_video_len = int(video_lens.max())
 
     # Max Token Len
-    max_tokens_len = max(tokens_lengths).item()
+    tokens_lens = np.fromiter((b['tokens_len'] for b in batch), dtype=np.int64, count=batch_size)
+    max_tokens_len = int(tokens_lens.max())
 
-    video_signal, tokens = [], []
-    for b in batch:
+    # Preallocate padded outputs, each sample is copied once into its slice
+    video_signal = torch.zeros((batch_size, max_video_len) + tuple(batch[0]['video'].shape[1:]), dtype=torch.uint8)
+    tokens = torch.full((batch_size, max_tokens_len), pad_id, dtype=torch.long)
 
-        if len(b) == 5:
-            video_sig, video_sig_len, tokens_i, tokens_i_len, _ = b
-        else:
-            video_sig, video_sig_len, tokens_i, tokens_i_len = b
-
-        # Pad and Append Video
-        if has_video:
-            video_sig_len = video_sig_len.item()
-            if video_sig_len < max_video_len:
-                pad = (0, 0, 0, 0, 0, 0, 0, max_video_len - video_sig_len)
-                video_sig = torch.nn.functional.pad(video_sig, pad)
-            video_signal.append(video_sig)
-
-        # Pad and Append Token
-        tokens_i_len = tokens_i_len.item()
-        if tokens_i_len < max_tokens_len:
-            pad = (0, max_tokens_len - tokens_i_len)
-            tokens_i = torch.nn.functional.pad(tokens_i, pad, value=pad_id)
-        tokens.append(tokens_i)
-
-    # Stack Video
-    if has_video:
-        video_signal = torch.stack(video_signal)
-        video_lengths = torch.stack(video_lengths)
-    else:
-        video_signal, video_lengths = None, None
+    for i, b in enumerate(batch):
+
+        # Video frames must stay uint8 until the model preprocessor converts them on device,
+        # copying any other dtype into the uint8 buffer would silently truncate it
+        if b['video'].dtype != torch.uint8:
+            raise TypeError(f"Expected uint8 video frames, got {b['video'].dtype} for sample {i} of the batch")
 
-    # Stack Text
-    tokens = torch.stack(tokens)
-    tokens_lengths = torch.stack(tokens_lengths)
+        # Copy Video
+        video_signal[i, : video_lens[i]].copy_(b['video'])
+
+        # Copy Token
+        tokens[i, : tokens_lens[i]].copy_(b['tokens'])
+
+    # Lengths
+    video_lengths = torch.from_numpy(video_lens)
+    tokens_lengths = torch.from_numpy(tokens_lens)
 
     # Return
-    if sample_ids is None:
+    if 'sample_id' not in batch[0]:
         return video_signal, video_lengths, tokens, tokens_lengths
     else:
-        sample_ids = torch.tensor(sample_ids, dtype=torch.int32)
+        sample_ids = torch.tensor([b['sample_id'] for b in batch], dtype=torch.int32)
         return video_signal, video_lengths, tokens, tokens_lengths, sample_ids
 
 
+class _TokenizerWrapper:
+    """Wraps a tokenizer into a manifest parser, multilingual manifests pass a list of language spans
+    to aggregate tokenizers. Defined at module level so that datasets can be pickled into DataLoader workers.
+    """
+
+    def __init__(self, tokenizer):
+        if isinstance(tokenizer, tokenizers.aggregate_tokenizer.AggregateTokenizer):
+            self.is_aggregate = True
+        else:
+            self.is_aggregate = False
+        self._tokenizer = tokenizer
+
+    def __call__(self, *args):
+        if isinstance(args[0], List) and self.is_aggregate:
+            text_to_ids = self._tokenizer.text_to_ids
+            return [token for span in args[0] for token in text_to_ids(span['str'], span['lang'])]
+
+        t = self._tokenizer.text_to_ids(*args)
+        return t
+
+
 class _VideoTextDataset(Dataset):
     """
     Dataset that loads tensors via a json file containing paths to video files, transcripts, and durations (in seconds).
@@ -113,13 +123,17 @@ class _VideoTextDataset(Dataset):
         int_values (bool): If true, load samples as 32-bit integers. Defauts to False.
         max_duration: If video exceeds this length, do not include in dataset
         min_duration: If video is less than this length, do not include in dataset
-        max_utts: Limit number of utterances
+        max_utts: Limit number of utterances, counted after duration filtering
         trim: whether or not to trim silence. Defaults to False
         bos_id: Id of beginning of sequence symbol to append if not None
         eos_id: Id of end of sequence symbol to append if not None
         pad_id: Id of pad symbol. Defaults to 0
         return_sample_id (bool): whether to return the sample_id as a part of each sample
         channel_selector (int | Iterable[int] | str): select a single channel or a subset of channels from multi-channel audio. If set to `'average'`, it performs averaging across channels. Disabled if set to `None`. Defaults to `None`. Uses zero-based indexing.
+        num_decode_threads (int): Number of threads decoding the samples of a batch concurrently in each process.
+            Set to 1 to decode sequentially, e.g. when many DataLoader workers already use all CPU cores. Defaults to 4.
+        frame_rate (float): Frame rate of pre-extracted .npy frame arrays, used to convert the manifest offset and
+            duration to frame indices. Defaults to 25.
     """
 
     @property
@@ -148,6 +162,8 @@ class _VideoTextDataset(Dataset):
         pad_id: int = 0,
         return_sample_id: bool = False,
         channel_selector: Optional[ChannelSelectorType] = None,
+        num_decode_threads: int = 4,
+        frame_rate: float = 25.0,
     ):
         if type(manifest_filepath) == str:
             manifest_filepath = manifest_filepath.split(",")
@@ -165,10 +181,13 @@ class _VideoTextDataset(Dataset):
             eos_id=eos_id,
             pad_id=pad_id,
         )
-        self.video_featurizer = VideoFeaturizer()
+        self.video_featurizer = VideoFeaturizer(frame_rate=frame_rate)
         self.trim = trim
         self.return_sample_id = return_sample_id
         self.channel_selector = channel_selector
+        self.num_decode_threads = num_decode_threads
+        self._decode_pool = None
+        self._decode_pool_pid = None
 
     def get_manifest_sample(self, sample_id):
         return self.manifest_processor.collection[sample_id]
@@ -185,24 +204,82 @@ class _VideoTextDataset(Dataset):
 
         # Load Video
         video_features = self.video_featurizer.process(sample.video_file, offset=offset, duration=sample.duration)
-        vf, vfl = video_features, torch.tensor(video_features.shape[0]).long()
+        vf, vfl = video_features, video_features.shape[0]
 
         # Load Tokens
-        t, tl = self.manifest_processor.process_text_by_sample(sample=sample)
+        t, tl = self.manifest_processor.process_text_by_id(index)
+        t = torch.from_numpy(t)
 
+        output = {'video': vf, 'video_len': vfl, 'tokens': t, 'tokens_len': tl}
         if self.return_sample_id:
-            output = vf, vfl, torch.tensor(t).long(), torch.tensor(tl).long(), index
-        else:
-            output = vf, vfl, torch.tensor(t).long(), torch.tensor(tl).long()
+            output['sample_id'] = index
 
         return output
 
+    def __getitems__(self, indices):
+        if self.num_decode_threads <= 1 or len(indices) <= 1:
+            return [self.__getitem__(index) for index in indices]
+
+        # Decode the samples of a batch concurrently, video decoding releases the GIL.
+        # VideoFeaturizer keeps no decoder state between calls, so it can be shared across threads.
+        return list(self._get_decode_pool().map(self.__getitem__, indices))
+
+    def _get_decode_pool(self):
+        # One pool per process, reused across batches. DataLoader workers do not inherit the threads
+        # of a pool created in the parent process, so a new pool is created after a fork.
+        if self._decode_pool is None or self._decode_pool_pid != os.getpid():
+            self._decode_pool = ThreadPoolExecutor(max_workers=self.num_decode_threads)
+            self._decode_pool_pid = os.getpid()
+        return self._decode_pool
+
+    def __getstate__(self):
+        # Thread pools cannot be pickled into spawned DataLoader workers
+        state = self.__dict__.copy()
+        state['_decode_pool'] = None
+        state['_decode_pool_pid'] = None
+        return state
+
     def __len__(self):
         return len(self.manifest_processor.collection)
 
     def _collate_fn(self, batch):
         return _video_speech_collate_fn(batch, pad_id=self.manifest_processor.pad_id)
 
+    def build_dataloader(
+        self,
+        batch_size: int,
+        num_workers: int,
+        shuffle: bool = False,
+        drop_last: bool = False,
+        prefetch_factor: int = 4,
+        pin_memory: bool = True,
+        persistent_workers: bool = True,
+    ) -> torch.utils.data.DataLoader:
+        """Builds a DataLoader which decodes videos in background workers.
+        Args:
+            batch_size: Number of samples per batch.
+            num_workers: Number of DataLoader worker processes, must be positive.
+            shuffle: Whether to reshuffle the samples at every epoch.
+            drop_last: Whether to drop the last incomplete batch.
+            prefetch_factor: Number of batches loaded in advance by each worker.
+            pin_memory: Whether the main process copies batches into pinned memory before returning them.
+            persistent_workers: Whether to keep the workers (and their manifest copies) alive between epochs.
+        """
+        if num_workers <= 0:
+            raise ValueError(f"build_dataloader requires num_workers > 0, got {num_workers}")
+
+        return torch.utils.data.DataLoader(
+            dataset=self,
+            batch_size=batch_size,
+            collate_fn=self.collate_fn,
+            shuffle=shuffle,
+            drop_last=drop_last,
+            num_workers=num_workers,
+            prefetch_factor=prefetch_factor,
+            pin_memory=pin_memory,
+            persistent_workers=persistent_workers,
+        )
+
 
 class VSRManifestProcessor:
     """
@@ -217,10 +294,13 @@ class VSRManifestProcessor:
         parser: Str for a language specific preprocessor or a callable.
         max_duration: If video exceeds this length, do not include in dataset.
         min_duration: If video is less than this length, do not include in dataset.
-        max_utts: Limit number of utterances.
+        max_utts: Limit number of utterances, counted after duration filtering.
         bos_id: Id of beginning of sequence symbol to append if not None.
         eos_id: Id of end of sequence symbol to append if not None.
         pad_id: Id of pad symbol. Defaults to 0.
+
+    Entries rejected by the duration filters or by the parser are dropped from the collection rather than masked,
+    so every collection index (and dataset index) refers to a sample that is actually loaded.
     """
 
     def __init__(
@@ -250,14 +330,20 @@ class VSRManifestProcessor:
         self.bos_id = bos_id
         self.pad_id = pad_id
 
-    def process_text_by_id(self, index: int) -> Tuple[List[int], int]:
-        sample = self.collection[index]
-        return self.process_text_by_sample(sample)
+        # Wrap tokens with bos / eos once, collection entries are immutable namedtuples
+        self._text_tokens = [
+            np.asarray(self.process_text_by_sample(sample)[0], dtype=np.int64) for sample in self.collection
+        ]
+
+        if index_by_file_id:
+            self._file_id_to_index = {file_id: idx_list[0] for file_id, idx_list in self.collection.mapping.items()}
 
-    def process_text_by_file_id(self, file_id: str) -> Tuple[List[int], int]:
-        manifest_idx = self.collection.mapping[file_id][0]
-        sample = self.collection[manifest_idx]
-        return self.process_text_by_sample(sample)
+    def process_text_by_id(self, index: int) -> Tuple[np.ndarray, int]:
+        t = self._text_tokens[index]
+        return t, len(t)
+
+    def process_text_by_file_id(self, file_id: str) -> Tuple[np.ndarray, int]:
+        return self.process_text_by_id(self._file_id_to_index[file_id])
 
     def process_text_by_sample(self, sample: collections.ASRAudioText.OUTPUT_TYPE) -> Tuple[List[int], int]:
         t, tl = sample.text_tokens, len(sample.text_tokens)
@@ -298,12 +384,16 @@ class VideoToBPEDataset(_VideoTextDataset):
         max_duration: If video exceeds this length, do not include in dataset
         min_duration: If video is less than this length, do not include
             in dataset
-        max_utts: Limit number of utterances
+        max_utts: Limit number of utterances, counted after duration filtering
         trim: Whether to trim silence segments
         use_start_end_token: Boolean which dictates whether to add [BOS] and [EOS]
             tokens to beginning and ending of speech respectively.
         return_sample_id (bool): whether to return the sample_id as a part of each sample
         channel_selector (int | Iterable[int] | str): select a single channel or a subset of channels from multi-channel audio. If set to `'average'`, it performs averaging across channels. Disabled if set to `None`. Defaults to `None`. Uses zero-based indexing.
+        num_decode_threads (int): Number of threads decoding the samples of a batch concurrently in each process.
+            Set to 1 to decode sequentially, e.g. when many DataLoader workers already use all CPU cores. Defaults to 4.
+        frame_rate (float): Frame rate of pre-extracted .npy frame arrays, used to convert the manifest offset and
+            duration to frame indices. Defaults to 25.
     """
 
     @property
@@ -330,6 +420,8 @@ class VideoToBPEDataset(_VideoTextDataset):
         use_start_end_token: bool = True,
         return_sample_id: bool = False,
         channel_selector: Optional[ChannelSelectorType] = None,
+        num_decode_threads: int = 4,
+        frame_rate: float = 25.0,
     ):
         if use_start_end_token and hasattr(tokenizer, "bos_id") and tokenizer.bos_id > 0:
             bos_id = tokenizer.bos_id
@@ -346,27 +438,9 @@ class VideoToBPEDataset(_VideoTextDataset):
         else:
             pad_id = 0
 
-        class TokenizerWrapper:
-            def __init__(self, tokenizer):
-                if isinstance(tokenizer, tokenizers.aggregate_tokenizer.AggregateTokenizer):
-                    self.is_aggregate = True
-                else:
-                    self.is_aggregate = False
-                self._tokenizer = tokenizer
-
-            def __call__(self, *args):
-                if isinstance(args[0], List) and self.is_aggregate:
-                    t = []
-                    for span in args[0]:
-                        t.extend(self._tokenizer.text_to_ids(span['str'], span['lang']))
-                    return t
-
-                t = self._tokenizer.text_to_ids(*args)
-                return t
-
         super().__init__(
             manifest_filepath=manifest_filepath,
-            parser=TokenizerWrapper(tokenizer),
+            parser=_TokenizerWrapper(tokenizer),
             int_values=int_values,
             max_duration=max_duration,
             min_duration=min_duration,
@@ -377,6 +451,8 @@ class VideoToBPEDataset(_VideoTextDataset):
             trim=trim,
             return_sample_id=return_sample_id,
             channel_selector=channel_selector,
+            num_decode_threads=num_decode_threads,
+            frame_rate=frame_rate,
         )
 
 
@@ -400,7 +476,7 @@ class VideoToCharDataset(_VideoTextDataset):
         max_duration: If video exceeds this length, do not include in dataset
         min_duration: If video is less than this length, do not include
             in dataset
-        max_utts: Limit number of utterances
+        max_utts: Limit number of utterances, counted after duration filtering
         blank_index: blank character index, default = -1
         unk_index: unk_character index, default = -1
         normalize: whether to normalize transcript text (default): True
@@ -408,6 +484,10 @@ class VideoToCharDataset(_VideoTextDataset):
         eos_id: Id of end of sequence symbol to append if not None
         return_sample_id (bool): whether to return the sample_id as a part of each sample
         channel_selector (int | Iterable[int] | str): select a single channel or a subset of channels from multi-channel audio. If set to `'average'`, it performs averaging across channels. Disabled if set to `None`. Defaults to `None`. Uses zero-based indexing.
+        num_decode_threads (int): Number of threads decoding the samples of a batch concurrently in each process.
+            Set to 1 to decode sequentially, e.g. when many DataLoader workers already use all CPU cores. Defaults to 4.
+        frame_rate (float): Frame rate of pre-extracted .npy frame arrays, used to convert the manifest offset and
+            duration to frame indices. Defaults to 25.
     """
 
     @property
@@ -440,6 +520,8 @@ class VideoToCharDataset(_VideoTextDataset):
         parser: Union[str, Callable] = 'en',
         return_sample_id: bool = False,
         channel_selector: Optional[ChannelSelectorType] = None,
+        num_decode_threads: int = 4,
+        frame_rate: float = 25.0,
     ):
         self.labels = labels
 
@@ -460,6 +542,8 @@ class VideoToCharDataset(_VideoTextDataset):
             pad_id=pad_id,
             return_sample_id=return_sample_id,
             channel_selector=channel_selector,
+            num_decode_threads=num_decode_threads,
+            frame_rate=frame_rate,
         )
 
 
@@ -537,6 +621,9 @@ class _TarredVideoToTextDataset(IterableDataset):
                 available in the tarred dataset, which are permanently pre-allocated and never changed at runtime.
                 The benefit of replication is that it allows each node to sample data points from the entire
                 dataset independently of other nodes, and reduces dependence on value of `shuffle_n`.
+            -   `rotate`: Optional shard strategy, where each node gets a unique set of shards like `scatter`,
+                but the assignment of shards to nodes changes at every epoch set through ``set_epoch``,
+                so that each node sees a different part of the dataset across epochs.
 
                 .. warning::
                     Replicated strategy allows every node to sample the entire set of available tarfiles,
@@ -549,6 +636,21 @@ class _TarredVideoToTextDataset(IterableDataset):
         global_rank (int): Worker rank, used for partitioning shards. Defaults to 0.
         world_size (int): Total number of processes, used for partitioning shards. Defaults to 0.
         return_sample_id (bool): whether to return the sample_id as a part of each sample
+        cache_dir (str): Optional local directory in which WebDataset caches the tarball shards it has read,
+            so that later epochs read remote shards sequentially from local disk. Defaults to None (no caching).
+        prefetch_n (int): How many raw samples a background thread reads ahead of decoding, so that opening and
+            downloading the next shard overlaps with processing the current one. Defaults to 0 (disabled).
+        video_cache_dir (str): Optional local directory in which decoded videos are cached as .npy files, keyed by
+            file id and the manifest offset and duration of the decoded window, so that later epochs skip video
+            decoding. Use a separate directory for each dataset. Defaults to None (no caching).
+        sort_n (int): Size of the window of samples sorted by manifest duration before decoding, so that
+            consecutive samples batched together have similar lengths and need less padding. Sorting happens
+            after shuffling, so it should be used together with `shuffle_n`. Defaults to 0 (disabled).
+        sort_chunk_size (int): Optional number of consecutive samples kept together after sorting a window, the order
+            of these chunks is shuffled within the window so that batches do not go from short to long. Should be
+            the batch size, `sort_n` must be a multiple of it. Defaults to None (sorted order is kept).
+        frame_rate (float): Frame rate of the videos when no frame rate is stored in the video stream, used to size
+            the decoding buffer. Defaults to 25.
     """
 
     def __init__(
@@ -568,6 +670,12 @@ class _TarredVideoToTextDataset(IterableDataset):
         global_rank: int = 0,
         world_size: int = 0,
         return_sample_id: bool = False,
+        cache_dir: Optional[str] = None,
+        prefetch_n: int = 0,
+        video_cache_dir: Optional[str] = None,
+        sort_n: int = 0,
+        sort_chunk_size: Optional[int] = None,
+        frame_rate: float = 25.0,
     ):
         # If necessary, cache manifests from object store
         cache_datastore_manifests(manifest_filepaths=manifest_filepath)
@@ -584,22 +692,60 @@ class _TarredVideoToTextDataset(IterableDataset):
             index_by_file_id=True,  # Must set this so the manifest lines can be indexed by file ID
         )
 
-        self.video_featurizer = VideoFeaturizer()
+        self.video_featurizer = VideoFeaturizer(frame_rate=frame_rate)
         self.trim = trim
         self.eos_id = eos_id
         self.bos_id = bos_id
         self.pad_id = pad_id
         self.return_sample_id = return_sample_id
+        self.prefetch_n = prefetch_n
+        self.video_cache_dir = video_cache_dir
+        self.sort_n = sort_n
+        self.sort_chunk_size = sort_chunk_size
+        if sort_n > 0 and sort_chunk_size is not None and sort_n % sort_chunk_size != 0:
+            raise ValueError(
+                f"sort_n ({sort_n}) must be a multiple of sort_chunk_size ({sort_chunk_size}), otherwise the "
+                "partial chunk of each window would misalign all the following batches"
+            )
+        if video_cache_dir is not None:
+            os.makedirs(video_cache_dir, exist_ok=True)
+
+        # Number of manifest utterances (offsets) of each file in the tarballs
+        self._num_offsets = {
+            file_id: len(offset_list) for file_id, offset_list in self.manifest_processor.collection.mapping.items()
+        }
+
+        self.shard_strategy = shard_strategy
+        self.global_rank = global_rank
+        self.world_size = world_size
+        self._epoch = 0
 
+        # With `rotate`, every rank keeps the full shard list and picks its subset at each iteration
+        rotate = shard_strategy == 'rotate' and world_size > 1
         audio_tar_filepaths = expand_sharded_filepaths(
-            audio_tar_filepaths=audio_tar_filepaths,
-            shard_strategy=shard_strategy,
-            world_size=world_size,
+            sharded_filepaths=audio_tar_filepaths,
+            shard_strategy='scatter' if shard_strategy == 'rotate' else shard_strategy,
+            world_size=1 if rotate else world_size,
             global_rank=global_rank,
         )
+        nodesplitter = None
+        if rotate:
+            logging.info("Tarred dataset shards will be scattered across all nodes and rotated at every epoch.")
+            if len(audio_tar_filepaths) < world_size:
+                logging.warning(
+                    f"Number of shards in tarred dataset ({len(audio_tar_filepaths)}) is smaller than the number "
+                    f"of distributed workers ({world_size}), some shards will be read by more than one node."
+                )
+            nodesplitter = self._rotate_shards
+
+        # Put together WebDataset, tar members are streamed sequentially from each shard
+        if cache_dir is not None:
+            self._dataset = wd.WebDataset(urls=audio_tar_filepaths, nodesplitter=nodesplitter, cache_dir=cache_dir)
+        else:
+            self._dataset = wd.WebDataset(urls=audio_tar_filepaths, nodesplitter=nodesplitter)
 
-        # Put together WebDataset
-        self._dataset = wd.WebDataset(urls=audio_tar_filepaths, nodesplitter=None)
+        if prefetch_n > 0:
+            self._dataset = self._dataset.pipe(self._prefetch)
 
         if shuffle_n > 0:
             self._dataset = self._dataset.shuffle(shuffle_n)
@@ -607,84 +753,168 @@ class _TarredVideoToTextDataset(IterableDataset):
             logging.info("WebDataset will not shuffle files within the tar files.")
 
         self._dataset = (
-            self._dataset.map(wd.autodecode.Decoder([wd.torch_video]))
-            .rename(video="mp4", key='__key__')
+            self._dataset.rename(video="mp4", key='__key__')
             .to_tuple('video', 'key')
-            .pipe(self._filter)
-            .pipe(self._loop_offsets)
-            .map(f=self._build_sample)
+            .pipe(self._filter_and_loop_offsets)
         )
 
-    def _filter(self, iterator):
-        """This function is used to remove samples that have been filtered out by ASRVideoText already.
+        if sort_n > 0:
+            self._dataset = self._dataset.pipe(self._sort_by_duration)
+
+        self._dataset = self._dataset.map(f=self._build_sample)
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Sets the epoch used by the `rotate` shard strategy to pick the shards of this rank.
+        Should be called before the dataset is iterated at the start of each epoch.
+        """
+        self._epoch = epoch
+
+    def _rotate_shards(self, urls):
+        """This function selects the shards read by this rank for the current epoch.
+        The shard list is rotated by epoch * world_size and rank r takes every world_size-th shard starting from r,
+        i.e. shards (epoch * world_size + r + k * world_size) % len(urls). The ranks read disjoint sets of shards and
+        all ranks take the same number of shards. The remainder left out in one epoch is read in the following ones.
+        When there are fewer shards than ranks, each rank reads a single shard, shared with other ranks.
+        """
+        urls = list(urls)
+        if len(urls) == 0:
+            return urls
+
+        shift = (self._epoch * self.world_size) % len(urls)
+        urls = urls[shift:] + urls[:shift]
+
+        if len(urls) < self.world_size:
+            return [urls[self.global_rank % len(urls)]]
+
+        num_shards = len(urls) // self.world_size
+        return urls[self.global_rank :: self.world_size][:num_shards]
+
+    def _prefetch(self, iterator):
+        """This function reads up to prefetch_n raw samples ahead of the rest of the pipeline in a background thread.
+        Shards are opened and downloaded while the samples of the previous shard are still being processed,
+        which hides object store latency at shard boundaries.
+        """
+        buffer = queue.Queue(maxsize=self.prefetch_n)
+        stop = threading.Event()
+        end_of_stream = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def read_ahead():
+            try:
+                for sample in iterator:
+                    if not put((sample, None)):
+                        return
+                put((end_of_stream, None))
+            except Exception as e:
+                put((end_of_stream, e))
+
+        thread = threading.Thread(target=read_ahead, daemon=True)
+        thread.start()
+        try:
+            while True:
+                sample, error = buffer.get()
+                if sample is end_of_stream:
+                    if error is not None:
+                        raise error
+                    return
+                yield sample
+        finally:
+            stop.set()
+
+    def _filter_and_loop_offsets(self, iterator):
+        """This function removes samples that have been filtered out by ASRVideoText already and iterates through
+        the utterances with different offsets of each remaining file.
         Otherwise, we would get a KeyError as _build_sample attempts to find the manifest entry for a sample
         that was filtered out (e.g. for duration).
         Note that if using multi-GPU training, filtering may lead to an imbalance in samples in each shard,
         which may make your code hang as one process will finish before the other.
         """
-
-        class TarredAudioFilter:
-            def __init__(self, collection):
-                self.iterator = iterator
-                self.collection = collection
-
-            def __iter__(self):
-                return self
-
-            def __next__(self):
-                while True:
-                    try:
-                        video_bytes, audio_filename = next(self.iterator)
-                    except:
-                        print("except")
-                        continue
-                    file_id, _ = os.path.splitext(os.path.basename(audio_filename))
-                    if file_id in self.collection.mapping:
-                        return video_bytes, audio_filename
-
-        return TarredAudioFilter(self.manifest_processor.collection)
-
-    def _loop_offsets(self, iterator):
-        """This function is used to iterate through utterances with different offsets for each file.
+        num_offsets = self._num_offsets
+        for video_tuple, video_filename in iterator:
+            file_id, _ = os.path.splitext(os.path.basename(video_filename))
+            for offset_id in range(num_offsets.get(file_id, 0)):
+                yield video_tuple, file_id, offset_id
+
+    def _sort_by_duration(self, iterator):
+        """This function sorts windows of sort_n samples by their manifest duration.
+        When sort_chunk_size is set, the sorted window is split into chunks of sort_chunk_size samples of similar
+        duration, which are yielded in random order to avoid ordering every window from short to long samples.
+        Samples are only sorted before decoding, the window holds the encoded videos.
         """
-
-        class TarredAudioLoopOffsets:
-            def __init__(self, collection):
-                self.iterator = iterator
-                self.collection = collection
-                self.current_fn = None
-                self.current_video_bytes = None
-                self.offset_id = 0
-
-            def __iter__(self):
-                return self
-
-            def __next__(self):
-                if self.current_fn is None:
-                    self.current_video_bytes, self.current_fn = next(self.iterator)
-                    self.offset_id = 0
-                else:
-                    offset_list = self.collection.mapping[self.current_fn]
-                    if len(offset_list) == self.offset_id + 1:
-                        self.current_video_bytes, self.current_fn = next(self.iterator)
-                        self.offset_id = 0
-                    else:
-                        self.offset_id += 1
-
-                return self.current_video_bytes, self.current_fn, self.offset_id
-
-        return TarredAudioLoopOffsets(self.manifest_processor.collection)
+        collection = self.manifest_processor.collection
+        chunk_size = self.sort_chunk_size
+
+        def duration(sample):
+            _, file_id, offset_id = sample
+            return collection[collection.mapping[file_id][offset_id]].duration
+
+        def sort_and_shuffle(window):
+            window.sort(key=duration)
+            if chunk_size is None or chunk_size <= 1:
+                yield from window
+                return
+            chunks = [window[i : i + chunk_size] for i in range(0, len(window), chunk_size)]
+            random.shuffle(chunks)
+            for chunk in chunks:
+                yield from chunk
+
+        window = []
+        for sample in iterator:
+            window.append(sample)
+            if len(window) == self.sort_n:
+                yield from sort_and_shuffle(window)
+                window = []
+        yield from sort_and_shuffle(window)
 
     def _collate_fn(self, batch):
         return _video_speech_collate_fn(batch, self.pad_id)
 
+    def _decode_video(self, video_bytes, offset, duration):
+        """Decodes only the [offset, offset + duration] window of the video referenced by the manifest entry.
+        """
+        return self.video_featurizer.process(video_bytes, offset=offset, duration=duration)
+
+    def _load_video(self, video_bytes, file_id, offset, duration):
+        """Decodes the video of a sample, decoded videos are cached as .npy files when video_cache_dir is set.
+        Cache entries are keyed by the decoded window rather than by the position of the utterance in the manifest,
+        which changes with duration filtering or manifest edits.
+        """
+        if self.video_cache_dir is None:
+            return self._decode_video(video_bytes, offset=offset, duration=duration)
+
+        cache_path = os.path.join(self.video_cache_dir, f"{file_id}_{offset:.3f}_{duration:.3f}.npy")
+        if os.path.exists(cache_path):
+            return torch.from_numpy(np.load(cache_path, mmap_mode="c"))
+
+        video = self._decode_video(video_bytes, offset=offset, duration=duration)
+
+        # Write to a temporary file first so that other workers never read a partially written entry
+        f = tempfile.NamedTemporaryFile(dir=self.video_cache_dir, suffix=".tmp", delete=False)
+        try:
+            with f:
+                np.save(f, video.numpy())
+            os.replace(f.name, cache_path)
+        finally:
+            if os.path.exists(f.name):
+                os.remove(f.name)
+
+        return video
+
     def _build_sample(self, tup):
         """Builds the training sample by combining the data from the WebDataset with the manifest info.
         """
-        video_tuple, audio_filename, offset_id = tup
+        video_bytes, file_id, offset_id = tup
 
         # Grab manifest entry from self.manifest_preprocessor.collection
-        file_id, _ = os.path.splitext(os.path.basename(audio_filename))
         manifest_idx = self.manifest_processor.collection.mapping[file_id][offset_id]
         manifest_entry = self.manifest_processor.collection[manifest_idx]
 
@@ -693,27 +923,22 @@ class _TarredVideoToTextDataset(IterableDataset):
             offset = 0
 
         # Load Video
-        video_features = video_tuple[0]
+        video_features = self._load_video(
+            video_bytes, file_id=file_id, offset=offset, duration=manifest_entry.duration
+        )
 
         # Signal length
-        vf, vfl = video_features, torch.tensor(video_features.shape[0]).long()
+        vf, vfl = video_features, video_features.shape[0]
 
         # Load Tokens
-        t, tl = manifest_entry.text_tokens, len(manifest_entry.text_tokens)
-
-        self.manifest_processor.process_text_by_sample(sample=manifest_entry)
-
-        if self.bos_id is not None:
-            t = [self.bos_id] + t
-            tl += 1
-        if self.eos_id is not None:
-            t = t + [self.eos_id]
-            tl += 1
+        t, tl = self.manifest_processor.process_text_by_id(manifest_idx)
+        t = torch.from_numpy(t)
 
+        output = {'video': vf, 'video_len': vfl, 'tokens': t, 'tokens_len': tl}
         if self.return_sample_id:
-            return vf, vfl, torch.tensor(t).long(), torch.tensor(tl).long(), manifest_idx
-        else:
-            return vf, vfl, torch.tensor(t).long(), torch.tensor(tl).long()
+            output['sample_id'] = manifest_idx
+
+        return output
 
     def get_manifest_sample(self, sample_id):
         return self.manifest_processor.collection[sample_id]
@@ -786,6 +1011,9 @@ class TarredVideoToBPEDataset(_TarredVideoToTextDataset):
                 available in the tarred dataset, which are permanently pre-allocated and never changed at runtime.
                 The benefit of replication is that it allows each node to sample data points from the entire
                 dataset independently of other nodes, and reduces dependence on value of `shuffle_n`.
+            -   `rotate`: Optional shard strategy, where each node gets a unique set of shards like `scatter`,
+                but the assignment of shards to nodes changes at every epoch set through ``set_epoch``,
+                so that each node sees a different part of the dataset across epochs.
 
                 .. warning::
 
@@ -800,6 +1028,21 @@ class TarredVideoToBPEDataset(_TarredVideoToTextDataset):
         global_rank (int): Worker rank, used for partitioning shards. Defaults to 0.
         world_size (int): Total number of processes, used for partitioning shards. Defaults to 0.
         return_sample_id (bool): whether to return the sample_id as a part of each sample
+        cache_dir (str): Optional local directory in which WebDataset caches the tarball shards it has read,
+            so that later epochs read remote shards sequentially from local disk. Defaults to None (no caching).
+        prefetch_n (int): How many raw samples a background thread reads ahead of decoding, so that opening and
+            downloading the next shard overlaps with processing the current one. Defaults to 0 (disabled).
+        video_cache_dir (str): Optional local directory in which decoded videos are cached as .npy files, keyed by
+            file id and the manifest offset and duration of the decoded window, so that later epochs skip video
+            decoding. Use a separate directory for each dataset. Defaults to None (no caching).
+        sort_n (int): Size of the window of samples sorted by manifest duration before decoding, so that
+            consecutive samples batched together have similar lengths and need less padding. Sorting happens
+            after shuffling, so it should be used together with `shuffle_n`. Defaults to 0 (disabled).
+        sort_chunk_size (int): Optional number of consecutive samples kept together after sorting a window, the order
+            of these chunks is shuffled within the window so that batches do not go from short to long. Should be
+            the batch size, `sort_n` must be a multiple of it. Defaults to None (sorted order is kept).
+        frame_rate (float): Frame rate of the videos when no frame rate is stored in the video stream, used to size
+            the decoding buffer. Defaults to 25.
     """
 
     def __init__(
@@ -817,6 +1060,12 @@ class TarredVideoToBPEDataset(_TarredVideoToTextDataset):
         global_rank: int = 0,
         world_size: int = 0,
         return_sample_id: bool = False,
+        cache_dir: Optional[str] = None,
+        prefetch_n: int = 0,
+        video_cache_dir: Optional[str] = None,
+        sort_n: int = 0,
+        sort_chunk_size: Optional[int] = None,
+        frame_rate: float = 25.0,
     ):
         if use_start_end_token and hasattr(tokenizer, "bos_id") and tokenizer.bos_id > 0:
             bos_id = tokenizer.bos_id
@@ -833,28 +1082,10 @@ class TarredVideoToBPEDataset(_TarredVideoToTextDataset):
         else:
             pad_id = 0
 
-        class TokenizerWrapper:
-            def __init__(self, tokenizer):
-                if isinstance(tokenizer, tokenizers.aggregate_tokenizer.AggregateTokenizer):
-                    self.is_aggregate = True
-                else:
-                    self.is_aggregate = False
-                self._tokenizer = tokenizer
-
-            def __call__(self, *args):
-                if isinstance(args[0], Iterable) and self.is_aggregate:
-                    t = []
-                    for span in args[0]:
-                        t.extend(self._tokenizer.text_to_ids(span['str'], span['lang']))
-                    return t
-
-                t = self._tokenizer.text_to_ids(*args)
-                return t
-
         super().__init__(
             audio_tar_filepaths=audio_tar_filepaths,
             manifest_filepath=manifest_filepath,
-            parser=TokenizerWrapper(tokenizer),
+            parser=_TokenizerWrapper(tokenizer),
             int_values=int_values,
             shuffle_n=shuffle_n,
             min_duration=min_duration,
@@ -867,4 +1098,10 @@ class TarredVideoToBPEDataset(_TarredVideoToTextDataset):
             global_rank=global_rank,
             world_size=world_size,
             return_sample_id=return_sample_id,
+            cache_dir=cache_dir,
+            prefetch_n=prefetch_n,
+            video_cache_dir=video_cache_dir,
+            sort_n=sort_n,
+            sort_chunk_size=sort_chunk_size,
+            frame_rate=frame_rate,
         )
@@ -180,6 +180,8 @@ def get_bpe_dataset(config: dict, tokenizer: 'TokenizerSpec') -> video_to_text.V
         use_start_end_token=config.get('use_start_end_token', True),
         return_sample_id=config.get('return_sample_id', False),
         channel_selector=config.get('channel_selector', None),
+        num_decode_threads=config.get('num_decode_threads', 4),
+        frame_rate=config.get('frame_rate', 25.0),
     )
     return dataset
 
@@ -211,6 +213,8 @@ def get_char_dataset(config: dict) -> video_to_text.VideoToCharDataset:
         parser=config.get('parser', 'en'),
         return_sample_id=config.get('return_sample_id', False),
         channel_selector=config.get('channel_selector', None),
+        num_decode_threads=config.get('num_decode_threads', 4),
+        frame_rate=config.get('frame_rate', 25.0),
     )
     return dataset
 
@@ -278,6 +282,12 @@ def get_tarred_dataset(
                 global_rank=global_rank,
                 world_size=world_size,
                 return_sample_id=config.get('return_sample_id', False),
+                cache_dir=config.get('tarred_cache_dir', None),
+                prefetch_n=config.get('tarred_prefetch_n', 0),
+                video_cache_dir=config.get('video_cache_dir', None),
+                sort_n=config.get('tarred_sort_n', 0),
+                sort_chunk_size=config.get('tarred_sort_chunk_size', None),
+                frame_rate=config.get('frame_rate', 25.0),
             )
         if bucketing_weights:
             [datasets.append(dataset) for _ in range(bucketing_weights[dataset_idx])]
@@ -285,3 +295,18 @@ def get_tarred_dataset(
             datasets.append(dataset)
 
     return get_chain_dataset(datasets=datasets, ds_config=config)
+
+
+def set_dataset_epoch(dataset, epoch: int) -> None:
+    """
+    Sets the epoch of the datasets that depend on it, e.g. tarred datasets using the `rotate` shard strategy.
+    Datasets chained for bucketing are updated individually.
+
+    Args:
+        dataset: The dataset of the training dataloader.
+        epoch: Current training epoch.
+    """
+    for ds in getattr(dataset, 'datasets', [dataset]):
+        ds = getattr(ds, 'wrapped_dataset', ds)
+        if hasattr(ds, 'set_epoch'):
+            ds.set_epoch(epoch)
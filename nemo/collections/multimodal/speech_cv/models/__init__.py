@@ -12,16 +12,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-# CTC
-from nemo.collections.multimodal.speech_cv.models.visual_ctc_bpe_models import VisualEncDecCTCModelBPE
-from nemo.collections.multimodal.speech_cv.models.visual_ctc_models import VisualEncDecCTCModel
-from nemo.collections.multimodal.speech_cv.models.visual_hybrid_rnnt_ctc_bpe_models import (
-    VisualEncDecHybridRNNTCTCBPEModel,
-)
+import importlib
 
-# Hybrid CTC/RNN-T
-from nemo.collections.multimodal.speech_cv.models.visual_hybrid_rnnt_ctc_models import VisualEncDecHybridRNNTCTCModel
-from nemo.collections.multimodal.speech_cv.models.visual_rnnt_bpe_models import VisualEncDecRNNTBPEModel
+# Models are imported on first access (PEP 562), so that importing the package does not load every model module
+_lazy = {
+    # CTC
+    "VisualEncDecCTCModel": "visual_ctc_models",
+    "VisualEncDecCTCModelBPE": "visual_ctc_bpe_models",
+    # RNN-T
+    "VisualEncDecRNNTModel": "visual_rnnt_models",
+    "VisualEncDecRNNTBPEModel": "visual_rnnt_bpe_models",
+    # Hybrid CTC/RNN-T
+    "VisualEncDecHybridRNNTCTCModel": "visual_hybrid_rnnt_ctc_models",
+    "VisualEncDecHybridRNNTCTCBPEModel": "visual_hybrid_rnnt_ctc_bpe_models",
+}
 
-# RNN-T
-from nemo.collections.multimodal.speech_cv.models.visual_rnnt_models import VisualEncDecRNNTModel
+__all__ = list(_lazy)
+
+
+def __getattr__(name):
+    if name not in _lazy:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    obj = getattr(importlib.import_module(f"{__name__}.{_lazy[name]}"), name)
+    globals()[name] = obj
+    return obj
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -413,6 +413,10 @@ class VisualEncDecCTCModel(ASRModel, ExportableEncDecModel, ASRModuleMixin, Inte
                     "training batches will be used. Please set the trainer and rebuild the dataset."
                 )
 
+    def on_train_epoch_start(self):
+        if self._train_dl is not None:
+            video_to_text_dataset.set_dataset_epoch(self._train_dl.dataset, self.current_epoch)
+
     def setup_validation_data(self, val_data_config: Optional[Union[DictConfig, Dict]]):
         """
         Sets up the validation data loader via a Dict-like object.
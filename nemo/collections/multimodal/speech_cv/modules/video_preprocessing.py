@@ -53,7 +53,7 @@ class VideoPreprocessor(NeuralModule):
 
         self.transforms = nn.ModuleList()
 
-        # Convert float32 [0:255] -> [0:1]
+        # Convert uint8 [0:255] -> float32 [0:1], done on device to keep host to device copies in uint8
         if TORCHVISION_AVAILABLE:
             self.transforms.append(torchvision.transforms.ConvertImageDtype(dtype=torch.float32))
         else:
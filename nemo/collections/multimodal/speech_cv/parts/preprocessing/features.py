@@ -12,9 +12,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
+import math
 import os
 import tempfile
 
+import numpy as np
+import torch
+
+try:
+    import av
+
+    PYAV_AVAILABLE = True
+except (ImportError, ModuleNotFoundError):
+    PYAV_AVAILABLE = False
+
 try:
     import torchvision
 
@@ -24,8 +36,17 @@ except (ImportError, ModuleNotFoundError):
 
 
 class VideoFeaturizer(object):
-    def __init__(self):
-        pass
+    """Loads (Time, Height, Width, Channels) uint8 video frames from video files, video bytes or pre-extracted
+    frame arrays stored as .npy files. Frames stay uint8 through the data pipeline, conversion to float
+    and normalization are done on device by the VideoPreprocessor.
+
+    Args:
+        frame_rate: frame rate of pre-extracted .npy frame arrays, used to convert offset and duration
+            to frame indices. Defaults to 25.
+    """
+
+    def __init__(self, frame_rate: float = 25.0):
+        self.frame_rate = frame_rate
 
     def process(self, video_file, offset, duration):
 
@@ -36,11 +57,26 @@ class VideoFeaturizer(object):
 
     def from_file(self, video_file, offset, duration):
 
-        if not TORCHVISION_AVAILABLE:
+        # Load pre-extracted frames, memory-mapped to share the page cache across workers
+        if isinstance(video_file, str) and video_file.endswith(".npy"):
+            frames = np.load(video_file, mmap_mode="c")
+            start = int(round(offset * self.frame_rate))
+            end = start + int(round(duration * self.frame_rate))
+            video = torch.from_numpy(frames[start:end])
+
+        # Decode from filename straight into the output tensor
+        elif isinstance(video_file, str) and PYAV_AVAILABLE:
+            video = self.decode(video_file, offset=offset, duration=duration)
+
+        # Decode from bytes in memory, without writing them to a temporary file
+        elif isinstance(video_file, bytes) and PYAV_AVAILABLE:
+            video = self.decode(io.BytesIO(video_file), offset=offset, duration=duration)
+
+        elif not TORCHVISION_AVAILABLE:
             raise Exception("Reading Video requires torchvision")
 
         # Load from filename
-        if isinstance(video_file, str):
+        elif isinstance(video_file, str):
             video, audio, infos = torchvision.io.read_video(
                 video_file, start_pts=offset, end_pts=offset + duration, pts_unit="sec"
             )
@@ -60,3 +96,59 @@ class VideoFeaturizer(object):
             raise Exception("Unknown video data format")
 
         return video
+
+    def decode(self, video_file, offset, duration):
+        """Decodes the frames in [offset, offset + duration] seconds of a video file or file-like object with PyAV.
+        Frames are written into a uint8 tensor preallocated from the stream frame rate and frame count,
+        which avoids stacking the decoded frames into a second copy of the video.
+        """
+
+        end = offset + duration
+        video, num_frames = None, 0
+
+        with av.open(video_file) as container:
+            stream = container.streams.video[0]
+            frame_rate = float(stream.average_rate) if stream.average_rate else self.frame_rate
+
+            # Number of frames in the window, bounded by the number of frames of the stream when known
+            capacity = int(math.ceil(duration * frame_rate)) + 1
+            if stream.frames:
+                capacity = min(capacity, stream.frames)
+            elif stream.duration is not None:
+                stream_duration = float(stream.duration * stream.time_base)
+                capacity = min(capacity, int(math.ceil(stream_duration * frame_rate)) + 1)
+            capacity = max(capacity, 1)
+
+            # Seek to the closest key frame before offset
+            if offset > 0:
+                container.seek(int(offset / stream.time_base), stream=stream)
+
+            for frame in container.decode(stream):
+                if frame.time is None or frame.time < offset:
+                    continue
+                if frame.time > end:
+                    break
+
+                # Read the converted frame through its plane buffer rather than allocating an array per frame
+                frame = frame.reformat(format="rgb24")
+                plane = frame.planes[0]
+                array = np.frombuffer(plane, dtype=np.uint8).reshape(frame.height, plane.line_size)
+                array = array[:, : frame.width * 3].reshape(frame.height, frame.width, 3)
+
+                if video is None:
+                    video = torch.empty((capacity,) + array.shape, dtype=torch.uint8)
+                elif num_frames == video.shape[0]:
+                    grown = torch.empty((2 * num_frames,) + array.shape, dtype=torch.uint8)
+                    grown[:num_frames].copy_(video)
+                    video = grown
+                video[num_frames].numpy()[...] = array
+                num_frames += 1
+
+        if video is None:
+            return torch.empty((0, 1, 1, 3), dtype=torch.uint8)
+
+        # Release the unused part of the buffer when the estimate was well above the decoded number of frames
+        if num_frames < 0.75 * video.shape[0]:
+            return video[:num_frames].clone()
+
+        return video[:num_frames]
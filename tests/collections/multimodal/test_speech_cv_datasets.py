@@ -0,0 +1,407 @@
+# Copyright (c) 2023, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+import json
+import os
+import pickle
+import random
+import tarfile
+
+import numpy as np
+import pytest
+import torch
+
+from nemo.collections.common.parts.preprocessing import parsers
+from nemo.collections.multimodal.speech_cv.data.video_to_text import (
+    VideoToCharDataset,
+    _TarredVideoToTextDataset,
+    _video_speech_collate_fn,
+)
+from nemo.collections.multimodal.speech_cv.parts.preprocessing.features import PYAV_AVAILABLE, VideoFeaturizer
+
+LABELS = [" ", "a", "b", "c", "d", "e", "f", "g", "h", "i", "j", "k", "l", "m"]
+
+
+def make_sample(num_frames, tokens, sample_id=None):
+    sample = {
+        'video': torch.randint(1, 256, (num_frames, 4, 4, 3), dtype=torch.uint8),
+        'video_len': num_frames,
+        'tokens': torch.tensor(tokens, dtype=torch.long),
+        'tokens_len': len(tokens),
+    }
+    if sample_id is not None:
+        sample['sample_id'] = sample_id
+    return sample
+
+
+def write_tarred_dataset(tmpdir, entries, members):
+    """Writes a manifest with the given entries and a tarball containing the given (name, bytes) members."""
+    manifest_path = os.path.join(tmpdir, 'manifest.json')
+    with open(manifest_path, 'w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+
+    tar_path = os.path.join(tmpdir, 'video_0.tar')
+    with tarfile.open(tar_path, 'w') as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name=name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+    return manifest_path, tar_path
+
+
+def write_video(path, num_frames, frame_rate=25, size=32):
+    """Encodes num_frames frames whose pixel values are the frame index."""
+    import av
+
+    with av.open(path, mode='w') as container:
+        stream = container.add_stream('mpeg4', rate=frame_rate)
+        stream.width = size
+        stream.height = size
+        stream.pix_fmt = 'yuv420p'
+        for i in range(num_frames):
+            array = np.full((size, size, 3), i, dtype=np.uint8)
+            for packet in stream.encode(av.VideoFrame.from_ndarray(array, format='rgb24')):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+
+
+@pytest.fixture()
+def tarred_dataset(tmpdir):
+    entries = [
+        {'video_filepath': 'a.mp4', 'text': 'abc', 'offset': 0.0, 'duration': 1.0},
+        {'video_filepath': 'a.mp4', 'text': 'de', 'offset': 1.0, 'duration': 2.0},
+        {'video_filepath': 'b.mp4', 'text': 'f', 'offset': 0.0, 'duration': 1.5},
+        {'video_filepath': 'c.mp4', 'text': 'gh', 'offset': 0.0, 'duration': 100.0},
+    ]
+    members = [('a.mp4', b'a'), ('b.mp4', b'b'), ('c.mp4', b'c')]
+    manifest_path, tar_path = write_tarred_dataset(str(tmpdir), entries, members)
+    return _TarredVideoToTextDataset(
+        audio_tar_filepaths=tar_path,
+        manifest_filepath=manifest_path,
+        parser=parsers.make_parser(labels=LABELS, name='en'),
+        max_duration=10.0,
+    )
+
+
+class TestVideoSpeechCollate:
+    @pytest.mark.unit
+    def test_padding_and_lengths(self):
+        batch = [make_sample(3, [1, 2]), make_sample(5, [3, 4, 5, 6]), make_sample(1, [7])]
+        video, video_len, tokens, tokens_len = _video_speech_collate_fn(batch, pad_id=9)
+
+        assert video.shape == (3, 5, 4, 4, 3)
+        assert video.dtype == torch.uint8
+        assert video_len.tolist() == [3, 5, 1]
+        assert tokens_len.tolist() == [2, 4, 1]
+        assert tokens.tolist() == [[1, 2, 9, 9], [3, 4, 5, 6], [7, 9, 9, 9]]
+
+        for i, sample in enumerate(batch):
+            num_frames = sample['video_len']
+            assert torch.equal(video[i, :num_frames], sample['video'])
+            assert (video[i, num_frames:] == 0).all()
+
+    @pytest.mark.unit
+    def test_sample_ids(self):
+        batch = [make_sample(2, [1], sample_id=4), make_sample(3, [2, 3], sample_id=7)]
+        outputs = _video_speech_collate_fn(batch, pad_id=0)
+
+        assert len(outputs) == 5
+        assert outputs[4].dtype == torch.int32
+        assert outputs[4].tolist() == [4, 7]
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('float_index', [0, 1])
+    def test_rejects_non_uint8_video(self, float_index):
+        batch = [make_sample(2, [1]), make_sample(2, [1])]
+        batch[float_index]['video'] = batch[float_index]['video'].float()
+
+        with pytest.raises(TypeError):
+            _video_speech_collate_fn(batch, pad_id=0)
+
+
+class TestVideoToCharDataset:
+    @pytest.mark.unit
+    @pytest.mark.parametrize('num_decode_threads', [1, 3])
+    def test_getitems(self, tmpdir, num_decode_threads):
+        manifest_path = os.path.join(str(tmpdir), 'manifest.json')
+        with open(manifest_path, 'w') as f:
+            for i in range(5):
+                frames_path = os.path.join(str(tmpdir), f'video_{i}.npy')
+                np.save(frames_path, np.full((25 * (i + 1), 4, 4, 3), i, dtype=np.uint8))
+                f.write(json.dumps({'video_filepath': frames_path, 'text': 'abc'[: i % 3 + 1], 'duration': i + 1}))
+                f.write('\n')
+
+        dataset = VideoToCharDataset(
+            manifest_filepath=manifest_path, labels=LABELS, num_decode_threads=num_decode_threads
+        )
+        indices = [4, 0, 2, 1]
+        for sample, index in zip(dataset.__getitems__(indices), indices):
+            expected = dataset[index]
+            assert sample['video_len'] == expected['video_len'] == 25 * (index + 1)
+            assert torch.equal(sample['video'], expected['video'])
+            assert torch.equal(sample['tokens'], expected['tokens'])
+
+        # The decode pool is reused across batches and dropped when the dataset is sent to workers
+        if num_decode_threads > 1:
+            assert dataset._get_decode_pool() is dataset._get_decode_pool()
+        assert pickle.loads(pickle.dumps(dataset))._decode_pool is None
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('frame_rate', [10.0, 25.0])
+    def test_npy_frames_window(self, tmpdir, frame_rate):
+        # Frame i of the array holds the value i
+        frames_path = os.path.join(str(tmpdir), 'video.npy')
+        np.save(frames_path, np.tile(np.arange(100, dtype=np.uint8)[:, None, None, None], (1, 4, 4, 3)))
+        manifest_path = os.path.join(str(tmpdir), 'manifest.json')
+        with open(manifest_path, 'w') as f:
+            f.write(json.dumps({'video_filepath': frames_path, 'text': 'abc', 'offset': 1.0, 'duration': 2.0}) + '\n')
+
+        dataset = VideoToCharDataset(manifest_filepath=manifest_path, labels=LABELS, frame_rate=frame_rate)
+        sample = dataset[0]
+
+        # The offset and duration are converted to frame indices with the dataset frame rate
+        first_frame, num_frames = int(1.0 * frame_rate), int(2.0 * frame_rate)
+        assert sample['video_len'] == num_frames
+        assert sample['video'].shape == (num_frames, 4, 4, 3)
+        assert sample['video'][:, 0, 0, 0].tolist() == list(range(first_frame, first_frame + num_frames))
+
+class TestTarredVideoToTextDataset:
+    @pytest.mark.unit
+    def test_filter_and_loop_offsets(self, tarred_dataset):
+        raw_samples = [(b'a', 'a'), (b'c', 'c'), (b'b', 'b'), (b'x', 'unknown')]
+        samples = list(tarred_dataset._filter_and_loop_offsets(iter(raw_samples)))
+
+        # c is filtered out by max_duration, unknown is not in the manifest
+        assert samples == [(b'a', 'a', 0), (b'a', 'a', 1), (b'b', 'b', 0)]
+
+    @pytest.mark.unit
+    def test_iterate(self, tarred_dataset, monkeypatch):
+        decoded = []
+
+        def decode_video(video_bytes, offset, duration):
+            decoded.append((video_bytes, offset, duration))
+            return torch.full((int(duration * 25), 4, 4, 3), len(decoded), dtype=torch.uint8)
+
+        monkeypatch.setattr(tarred_dataset, '_decode_video', decode_video)
+        tarred_dataset.return_sample_id = True
+        samples = list(tarred_dataset)
+
+        # Raw tar bytes are decoded with the window of each manifest utterance, c is filtered out by max_duration
+        assert decoded == [(b'a', 0.0, 1.0), (b'a', 1.0, 2.0), (b'b', 0.0, 1.5)]
+        assert [sample['sample_id'] for sample in samples] == [0, 1, 2]
+        assert [sample['video_len'] for sample in samples] == [25, 50, 37]
+        assert [sample['tokens'].tolist() for sample in samples] == [[1, 2, 3], [4, 5], [6]]
+        assert [sample['tokens_len'] for sample in samples] == [3, 2, 1]
+
+        video, video_len, tokens, tokens_len, sample_ids = tarred_dataset._collate_fn(samples)
+        assert video.shape == (3, 50, 4, 4, 3)
+        assert video_len.tolist() == [25, 50, 37]
+        assert tokens.tolist() == [[1, 2, 3], [4, 5, 0], [6, 0, 0]]
+        assert tokens_len.tolist() == [3, 2, 1]
+        assert sample_ids.tolist() == [0, 1, 2]
+
+    @pytest.mark.unit
+    def test_prefetch(self, tarred_dataset):
+        tarred_dataset.prefetch_n = 2
+        assert list(tarred_dataset._prefetch(iter(range(10)))) == list(range(10))
+
+    @pytest.mark.unit
+    def test_prefetch_propagates_errors(self, tarred_dataset):
+        def failing_source():
+            yield 0
+            yield 1
+            raise RuntimeError("corrupted shard")
+
+        tarred_dataset.prefetch_n = 2
+        received = []
+        with pytest.raises(RuntimeError, match="corrupted shard"):
+            for sample in tarred_dataset._prefetch(failing_source()):
+                received.append(sample)
+        assert received == [0, 1]
+
+    @pytest.mark.unit
+    @pytest.mark.parametrize('num_shards, world_size', [(10, 4), (8, 4), (7, 2)])
+    def test_rotate_shards(self, tarred_dataset, num_shards, world_size):
+        urls = [f'shard_{i}.tar' for i in range(num_shards)]
+        tarred_dataset.world_size = world_size
+
+        seen = set()
+        for epoch in range(num_shards):
+            tarred_dataset.set_epoch(epoch)
+            rank_shards = []
+            for rank in range(world_size):
+                tarred_dataset.global_rank = rank
+                rank_shards.append(tarred_dataset._rotate_shards(urls))
+
+            # Every rank reads the same number of distinct shards, no shard is read by two ranks
+            assert all(len(shards) == num_shards // world_size for shards in rank_shards)
+            epoch_shards = [shard for shards in rank_shards for shard in shards]
+            assert len(set(epoch_shards)) == len(epoch_shards)
+            seen.update(epoch_shards)
+
+        # The shards left out in one epoch are read in the following ones
+        assert seen == set(urls)
+
+    @pytest.mark.unit
+    def test_rotate_shards_fewer_shards_than_ranks(self, tarred_dataset):
+        urls = ['shard_0.tar', 'shard_1.tar', 'shard_2.tar']
+        tarred_dataset.world_size = 4
+
+        for epoch in range(3):
+            tarred_dataset.set_epoch(epoch)
+            for rank in range(4):
+                tarred_dataset.global_rank = rank
+                assert len(tarred_dataset._rotate_shards(urls)) == 1
+
+    @staticmethod
+    def make_sorting_dataset(tmpdir, durations, **kwargs):
+        entries = [
+            {'video_filepath': f'{i}.mp4', 'text': 'abc', 'duration': duration} for i, duration in enumerate(durations)
+        ]
+        members = [(f'{i}.mp4', b'v') for i in range(len(durations))]
+        manifest_path, tar_path = write_tarred_dataset(str(tmpdir), entries, members)
+        return _TarredVideoToTextDataset(
+            audio_tar_filepaths=tar_path,
+            manifest_filepath=manifest_path,
+            parser=parsers.make_parser(labels=LABELS, name='en'),
+            **kwargs,
+        )
+
+    @pytest.mark.unit
+    def test_sort_by_duration_default(self, tmpdir):
+        durations = [3.0, 1.0, 8.0, 5.0, 2.0, 7.0, 4.0, 6.0]
+        dataset = self.make_sorting_dataset(tmpdir, durations, sort_n=4)
+        raw_samples = [(b'v', str(i), 0) for i in range(len(durations))]
+
+        # Without sort_chunk_size each window is yielded in sorted order
+        for seed in range(5):
+            random.seed(seed)
+            samples = list(dataset._sort_by_duration(iter(raw_samples)))
+            sample_durations = [durations[int(file_id)] for _, file_id, _ in samples]
+            assert sample_durations == [1.0, 3.0, 5.0, 8.0, 2.0, 4.0, 6.0, 7.0]
+
+    @pytest.mark.unit
+    def test_sort_chunk_size_must_divide_sort_n(self, tmpdir):
+        with pytest.raises(ValueError):
+            self.make_sorting_dataset(tmpdir, [1.0, 2.0], sort_n=5, sort_chunk_size=2)
+
+    @pytest.mark.unit
+    def test_sort_by_duration(self, tmpdir):
+        durations = [3.0, 1.0, 8.0, 5.0, 2.0, 7.0, 4.0, 6.0]
+        dataset = self.make_sorting_dataset(tmpdir, durations, sort_n=4, sort_chunk_size=2)
+        raw_samples = [(b'v', str(i), 0) for i in range(len(durations))]
+
+        orders = set()
+        for seed in range(20):
+            random.seed(seed)
+            samples = list(dataset._sort_by_duration(iter(raw_samples)))
+            sample_durations = [durations[int(file_id)] for _, file_id, _ in samples]
+
+            # Each window of 4 samples is split into 2 chunks of consecutive durations
+            assert sorted(sample_durations[:4]) == [1.0, 3.0, 5.0, 8.0]
+            assert sorted(sample_durations[4:]) == [2.0, 4.0, 6.0, 7.0]
+            chunks = [tuple(sample_durations[i : i + 2]) for i in range(0, 8, 2)]
+            assert set(chunks) == {(1.0, 3.0), (5.0, 8.0), (2.0, 4.0), (6.0, 7.0)}
+            orders.add(tuple(chunks))
+
+        # Chunks are not always yielded from short to long
+        assert len(orders) > 1
+
+    @pytest.mark.unit
+    def test_video_cache(self, tarred_dataset, tmpdir, monkeypatch):
+        decoded = []
+
+        def decode_video(video_bytes, offset, duration):
+            decoded.append((offset, duration))
+            return torch.full((int(duration * 25), 4, 4, 3), int(offset * 10), dtype=torch.uint8)
+
+        monkeypatch.setattr(tarred_dataset, '_decode_video', decode_video)
+        tarred_dataset.video_cache_dir = str(tmpdir.mkdir('video_cache'))
+
+        # Each window of the same file gets its own entry
+        first = tarred_dataset._load_video(b'a', file_id='a', offset=0.0, duration=1.0)
+        second = tarred_dataset._load_video(b'a', file_id='a', offset=1.0, duration=2.0)
+        assert decoded == [(0.0, 1.0), (1.0, 2.0)]
+        assert len(os.listdir(tarred_dataset.video_cache_dir)) == 2
+
+        # Cached windows are read back without decoding
+        assert torch.equal(tarred_dataset._load_video(b'a', file_id='a', offset=0.0, duration=1.0), first)
+        assert torch.equal(tarred_dataset._load_video(b'a', file_id='a', offset=1.0, duration=2.0), second)
+        assert len(decoded) == 2
+
+    @pytest.mark.unit
+    def test_video_cache_failed_write(self, tarred_dataset, tmpdir, monkeypatch):
+        def failing_save(*args, **kwargs):
+            raise OSError("disk full")
+
+        monkeypatch.setattr(
+            tarred_dataset, '_decode_video', lambda *args, **kwargs: torch.zeros((2, 4, 4, 3), dtype=torch.uint8)
+        )
+        monkeypatch.setattr(np, 'save', failing_save)
+        tarred_dataset.video_cache_dir = str(tmpdir.mkdir('video_cache'))
+
+        with pytest.raises(OSError, match="disk full"):
+            tarred_dataset._load_video(b'a', file_id='a', offset=0.0, duration=1.0)
+
+        # No partially written or temporary file is left behind
+        assert os.listdir(tarred_dataset.video_cache_dir) == []
+
+
+class TestVideoFeaturizer:
+    @pytest.mark.unit
+    @pytest.mark.skipif(not PYAV_AVAILABLE, reason="PyAV is not installed")
+    def test_window_decode(self, tmpdir):
+        video_path = os.path.join(str(tmpdir), 'video.mp4')
+        write_video(video_path, num_frames=50)
+        featurizer = VideoFeaturizer()
+
+        video = featurizer.process(video_path, offset=1.0, duration=0.4)
+
+        # Frames at 1.00, 1.04, ..., 1.40 seconds
+        assert video.dtype == torch.uint8
+        assert video.shape[1:] == (32, 32, 3)
+        assert 10 <= video.shape[0] <= 11
+        assert abs(video[0].float().mean().item() - 25) <= 3
+
+    @pytest.mark.unit
+    @pytest.mark.skipif(not PYAV_AVAILABLE, reason="PyAV is not installed")
+    def test_window_past_end_of_video(self, tmpdir):
+        video_path = os.path.join(str(tmpdir), 'video.mp4')
+        write_video(video_path, num_frames=50)
+        featurizer = VideoFeaturizer()
+
+        # The buffer is sized from the 50 frames of the stream, only the last 10 are decoded
+        video = featurizer.process(video_path, offset=1.6, duration=10.0)
+
+        assert 9 <= video.shape[0] <= 10
+        assert abs(video[-1].float().mean().item() - 49) <= 3
+
+        # The unused part of the buffer is not kept alive by the returned frames
+        assert video.untyped_storage().nbytes() == video.numel()
+
+    @pytest.mark.unit
+    @pytest.mark.skipif(not PYAV_AVAILABLE, reason="PyAV is not installed")
+    def test_decode_from_bytes(self, tmpdir):
+        video_path = os.path.join(str(tmpdir), 'video.mp4')
+        write_video(video_path, num_frames=50)
+        featurizer = VideoFeaturizer()
+
+        with open(video_path, 'rb') as f:
+            video_from_bytes = featurizer.process(f.read(), offset=1.0, duration=0.4)
+
+        # Decoding from bytes in memory returns the same frames as decoding the file
+        assert torch.equal(video_from_bytes, featurizer.process(video_path, offset=1.0, duration=0.4))